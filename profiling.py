@@ -0,0 +1,102 @@
+"""
+Per-phase profiling for the puzzle solvers, see Puzzle._phase.
+"""
+
+import cProfile, collections, contextlib, os, pstats, time, tracemalloc
+
+class Profiler:
+  """
+  Per-phase cProfile and tracemalloc instrumentation.
+
+  Each phase() dumps <prefix>.<phase>.pstats and <prefix>.<phase>.folded
+  (collapsed stacks, one "caller;callee self_us" line per call path, ready
+  for flamegraph.pl or speedscope), and records the tracemalloc peak and
+  top allocation sites for report(). Peaks are relative to the memory
+  already traced when the phase starts.
+
+  tracemalloc and cProfile both run during the timed section, so phase
+  times and pstats are inflated (several times over on solver-heavy
+  phases). Compare phases with each other, not with unprofiled runs.
+  """
+  top = 10
+
+  def __init__ (self, prefix):
+    self.prefix = prefix
+    self.phases = []
+
+  @contextlib.contextmanager
+  def phase (self, name):
+    if not tracemalloc.is_tracing():
+      tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    prof = cProfile.Profile()
+    start = time.perf_counter()
+    prof.enable()
+    try:
+      yield
+    finally:
+      prof.disable()
+      elapsed = time.perf_counter() - start
+      _, peak = tracemalloc.get_traced_memory()
+      ignore = [tracemalloc.Filter(False, f)
+                for f in (tracemalloc.__file__, cProfile.__file__, __file__)]
+      after = tracemalloc.take_snapshot().filter_traces(ignore)
+      sites = after.compare_to(before.filter_traces(ignore), 'lineno')
+
+      base = '{}.{}'.format(self.prefix, name)
+      prof.dump_stats(base + '.pstats')
+      with open(base + '.folded', 'w') as o:
+        for stack, us in collapse_stats(prof):
+          print('{} {}'.format(stack, us), file=o)
+      self.phases.append((name, elapsed, peak - baseline, sites[:self.top]))
+
+  def report (self, file=None):
+    if tracemalloc.is_tracing():
+      tracemalloc.stop()
+
+    print('Phase times include cProfile and tracemalloc overhead.', file=file)
+    for name, elapsed, peak, sites in self.phases:
+      print('{}: {:.3f}s, peak +{:.1f} KiB ({}.{}.pstats)'.format(
+        name, elapsed, peak / 1024, self.prefix, name), file=file)
+      for stat in sites:
+        if stat.size_diff:
+          print('  {}'.format(stat), file=file)
+
+def collapse_stats (prof):
+  """
+  Rebuild collapsed stacks from cProfile's caller/callee edges. cProfile only
+  keeps one level of callers, so time on each path is apportioned by the
+  share of the callee's cumulative time that came from that caller.
+  Recursive calls are folded into the outermost frame.
+  """
+  stats = pstats.Stats(prof).stats
+  callees = collections.defaultdict(list)
+  for func, (_, _, _, _, callers) in stats.items():
+    for caller, (_, _, _, ct) in callers.items():
+      callees[caller].append((func, ct))
+
+  def label (func):
+    filename, line, fname = func
+    if filename == '~':
+      return fname
+    return '{}:{}:{}'.format(os.path.basename(filename), line, fname)
+
+  out = collections.Counter()
+  def walk (func, share, stack):
+    _, _, tt, ct, _ = stats[func]
+    stack = stack + (label(func),)
+    if ct:
+      out[';'.join(stack)] += tt * share / ct
+    for callee, edge_ct in callees[func]:
+      part = edge_ct * share / ct if ct else 0
+      if part >= 1e-6 and label(callee) not in stack:
+        walk(callee, part, stack)
+
+  for func, (_, _, _, ct, callers) in stats.items():
+    if not callers:
+      walk(func, ct, ())
+
+  return [(stack, int(t * 1e6)) for stack, t in sorted(out.items())
+          if t >= 1e-6]
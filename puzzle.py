@@ -1,4 +1,4 @@
-import time, collections, os, re
+import time, collections, contextlib, json, os, queue, re, threading
 
 _base = ord('a') - 1
 expand = lambda c: ord(c) - _base
@@ -38,18 +38,71 @@ def merge_params (self, d):
       value = int(value)
     setattr(self, param, value)
 
+class SolveInterrupted (Exception):
+  def __init__ (self, reason):
+    super().__init__(reason)
+    self.reason = reason
+
+class CancelToken:
+  """
+  Cooperative cancellation flag. Safe to cancel() from another thread; the
+  solver notices at its next budget check and stops at a consistent state.
+  A multiprocessing.Event may be passed in to cancel across processes.
+  """
+  def __init__ (self, event=None):
+    self._event = event if event is not None else threading.Event()
+
+  def cancel (self):
+    self._event.set()
+
+  @property
+  def cancelled (self):
+    return self._event.is_set()
+
+SolveResult = collections.namedtuple('SolveResult', 'grid fixed reason')
+
 class Puzzle:
   puzzle_name = 'none'
   ex_game = '0x0'
 
   checking = set()
 
-  def __init__ (self, game_id, quiet=False, opengui=True, fast=False):
+  # Solver configurations raced by race(), keyed by name
+  portfolio = {
+    'default': {},
+    'edges-first': {'order': 'edges'},
+    'no-trials': {'expanded': False},
+    'search': {'search': True},
+    'edges-first-search': {'order': 'edges', 'search': True},
+  }
+
+  def __init__ (self, game_id, quiet=False, opengui=True, fast=False,
+                profiler=None, order='vertices', expanded=True, search=False):
     self._quiet = quiet
     self._opengui = opengui
     self._fast = fast
+    self._profiler = profiler
+    # order: queue 'vertices' or 'edges' first
+    # expanded: allow the expanded trial strategies once a node stalls
+    # search: guess and backtrack when propagation stalls
+    self.order = order
+    self.expanded = expanded
+    self.search = search
     self.moves = []
+    # Nodes flagged by a placement for a _recheck within the current solve
+    self.pending = []
 
+    with self._phase('parse'):
+      self._parse(game_id)
+    with self._phase('build'):
+      self._build()
+
+  def _phase (self, name):
+    if self._profiler is None:
+      return contextlib.nullcontext()
+    return self._profiler.phase(name)
+
+  def _parse (self, game_id):
     m = re.match(game_id_re, game_id)
     if m:
       merge_params(self, m.groupdict().items())
@@ -69,6 +122,7 @@ class Puzzle:
           elif param == 'MOVE':
             moves.append(val)
 
+  def _build (self):
     self.unsolved_nodes = collections.deque()
 
     self._pre_configure()
@@ -85,7 +139,12 @@ class Puzzle:
         pos_y += 1
         pos_x -= self.width + 1
 
+    self._post_configure()
+
     self.total_moves = 0
+    self._trials = []
+    # Visits in a row without progress, kept across propagate() calls
+    self._stall = 0
     moves = self.moves
     self.moves = []
     for move in moves:
@@ -93,15 +152,18 @@ class Puzzle:
       x, y = (int(v) for v in move[1:].split(','))
       self.edge[y][x].state = s
 
-    for y in range(0, self.height+1):
-      for x in range(0, self.width+1):
-        if not self.vertex[y][x].solved:
-          self.unsolved_nodes.append(self.vertex[y][x])
-
-    for y in range(0, self.height):
-      for x in range(0, self.width):
-        if not self.edge[y][x].solved:
-          self.unsolved_nodes.append(self.edge[y][x])
+    vertices = [self.vertex[y][x]
+                for y in range(0, self.height+1)
+                for x in range(0, self.width+1)
+                if not self.vertex[y][x].solved]
+    edges = [self.edge[y][x]
+             for y in range(0, self.height)
+             for x in range(0, self.width)
+             if not self.edge[y][x].solved]
+    if self.order == 'edges':
+      vertices, edges = edges, vertices
+    self.unsolved_nodes.extend(vertices)
+    self.unsolved_nodes.extend(edges)
 
 
   def _pre_configure (self):
@@ -110,6 +172,9 @@ class Puzzle:
   def _configure (self, x, y, val):
     pass
 
+  def _post_configure (self):
+    pass
+
   @property
   def game_params (self):
     return '{}x{}{}{}'.format(self.width, self.height, self.type or '',
@@ -149,6 +214,8 @@ class Puzzle:
       mark = len(self.moves) - 1
     while len(self.moves) > mark:
       self._undo(self.moves.pop())
+    while self._trials and self._trials[-1] >= mark:
+      self._trials.pop()
 
   def _undo (self, move):
     pass
@@ -156,26 +223,178 @@ class Puzzle:
   def undo_mark (self):
     return len(self.moves)
 
-  def solve (self):
-    j = 0
+  def trial_mark (self):
+    """
+    An undo mark for tentative moves. Until undo() rolls back past it, an
+    interrupted solve discards everything from here on and keeps the sound
+    deductions made before it.
+    """
+    mark = self.undo_mark()
+    self._trials.append(mark)
+    return mark
+
+  def _interrupted (self, node):
+    if self._trials:
+      self.undo(self._trials[0])
+    self._trials = []
+    # Resume with the nodes the kept deductions touched
+    self.unsolved_nodes.append(node)
+    kept = self.moves[self._run_mark:]
+    self.unsolved_nodes.extendleft(self._affected(kept))
+    return bool(kept)
+
+  def _affected (self, moves):
+    return []
+
+  _deadline = None
+  _max_moves = None
+  _cancel = None
+  def _check_budget (self):
+    if self._cancel is not None and self._cancel.cancelled:
+      raise SolveInterrupted('cancelled')
+    if self._max_moves is not None and self.total_moves >= self._max_moves:
+      raise SolveInterrupted('max_moves')
+    if self._deadline is not None and time.monotonic() >= self._deadline:
+      raise SolveInterrupted('timeout')
+
+  def _grid (self):
+    return None
+
+  def _verified (self):
+    """
+    Independent check of a finished grid, so search never reports a guess
+    that slipped past the solver's own checks as solved.
+    """
+    return True
+
+  def load_grid (self, grid):
+    """
+    Place the lines of a packed grid, e.g. one solved in another process.
+    """
+    self._load_grid(grid)
+    self.unsolved_nodes = collections.deque(n for n in self.unsolved_nodes
+                                            if not n.solved)
+
+  def _load_grid (self, grid):
+    pass
+
+  def _guesses (self):
+    """
+    Alternatives for search to try when propagation stalls, as callables
+    that each make one placement. An empty list means nothing to guess.
+    """
+    return []
+
+  def propagate (self, timeout=None, max_moves=None, cancel=None):
+    """
+    Run the solver until it finishes, stalls, or runs out of budget.
+
+    timeout is in seconds, max_moves caps the moves considered (trial
+    placements included) and cancel is a CancelToken. On any interruption
+    only the open trial placements are undone, so the returned grid holds
+    every sound deduction made so far and can be solved further later.
+    A budget smaller than one trial cannot make progress, since the trial
+    is discarded each time; resuming with it ends in 'stalled' sooner than
+    an unbudgeted run would.
+    """
+    self._deadline = (time.monotonic() + timeout if timeout is not None
+                      else None)
+    self._max_moves = (self.total_moves + max_moves if max_moves is not None
+                       else None)
+    self._cancel = cancel
+
+    try:
+      reason = self._run()
+      if reason == 'stalled' and self.search:
+        reason = self._search()
+    finally:
+      self._deadline = self._max_moves = self._cancel = None
+      self.checking = set()
+
+    return SolveResult(self._grid(), len(self.moves), reason)
+
+  def _stalled (self):
+    self._stall += 1
+    return self._stall >= len(self.unsolved_nodes)*2
+
+  def _run (self):
+    reason = 'solved'
     while self.unsolved_nodes:
+      self._run_mark = self.undo_mark()
+      node = self.unsolved_nodes.popleft()
       try:
-        node = self.unsolved_nodes.popleft()
+        self._check_budget()
         if node.solved:
-          j = 0
+          self._stall = 0
         else:
           if not node.solve(True):
             self.unsolved_nodes.append(node)
-            j += 1
-            if j == len(self.unsolved_nodes)*2:
+            if self._stalled():
+              reason = 'stalled'
               break
           else:
-            j = 0
+            self._stall = 0
+      except SolveInterrupted as e:
+        # A budget stop only counts as progress if deductions were kept
+        reason = e.reason
+        if self._interrupted(node):
+          self._stall = 0
+        elif self._stalled():
+          reason = 'stalled'
+        break
       except KeyboardInterrupt:
+        self._interrupted(node)
+        reason = 'interrupted'
         break
       except AssertionError as e:
+        reason = 'contradiction'
         break
-
+    return reason
+
+  def _search (self):
+    """
+    Depth-first guessing from a stalled position. Each guess is propagated
+    and searched further; failed guesses are undone along with the queue.
+    """
+    guesses = self._guesses()
+    if not guesses:
+      return 'stalled'
+
+    pending = list(self.unsolved_nodes)
+    reason = 'contradiction'
+    for guess in guesses:
+      mark = self.undo_mark()
+      try:
+        guess()
+        self._stall = 0
+        result = self._run()
+        if result == 'stalled':
+          result = self._search()
+      except AssertionError:
+        result = 'contradiction'
+      except SolveInterrupted as e:
+        result = e.reason
+      if result == 'solved':
+        if self._verified():
+          return result
+        result = 'contradiction'
+
+      self.undo(mark)
+      self.unsolved_nodes = collections.deque(pending)
+      if result == 'stalled':
+        reason = result
+      elif result != 'contradiction':
+        return result
+    return reason
+
+  def solve (self, timeout=None, max_moves=None, cancel=None):
+    with self._phase('propagate'):
+      result = self.propagate(timeout, max_moves, cancel)
+    with self._phase('output'):
+      self.save(result)
+    return result
+
+  def save (self, result=None):
     self.print(wait=0)
 
     filename = self.puzzle_name + '_soln.game'
@@ -196,6 +415,8 @@ class Puzzle:
         print('MOVE    :' + save_field(m), file=o)
 
     print(self.total_moves, 'moves considered.')
+    if result is not None and result.reason not in ('solved', 'stalled'):
+      print('Stopped:', result.reason)
     if self.unsolved_nodes:
       print('Failure...')
     else:
@@ -214,6 +435,13 @@ class Node:
   def solved (self):
     return False
 
+  def _recheck (self):
+    """
+    Cheap direct deductions for a node queued on puzzle.pending. Returns
+    the affected nodes, like _solve.
+    """
+    return False
+
   def solve (self, toplevel=False):
     self._solve_chain_initiator = toplevel
     self.puzzle.checking = set()
@@ -221,11 +449,16 @@ class Node:
     to_solve[self] = None
 
     while to_solve:
+      self.puzzle._check_budget()
       node, _ = to_solve.popitem()
       self.puzzle.checking.add(node)
       affected = node._solve()
       if affected:
         to_solve.update((n, None) for n in affected)
+      while self.puzzle.pending:
+        affected = self.puzzle.pending.pop()._recheck()
+        if affected:
+          to_solve.update((n, None) for n in affected)
 
     self.puzzle.checking = set()
     return self.solved
@@ -262,6 +495,85 @@ class DegreeNode (Node):
     assert self.degree <= self._degree and self.antidegree <= self._antidegree
     return self.degree + self.antidegree == self.cardinality
 
+def _race_worker (puzzle_class, game_id, name, config, timeout, max_moves,
+                  cancel, results):
+  start = time.perf_counter()
+  moves = 0
+  try:
+    p = puzzle_class(game_id, quiet=True, opengui=False, fast=True, **config)
+    result = p.propagate(timeout, max_moves, CancelToken(cancel))
+    moves = p.total_moves
+  except Exception as e:
+    result = SolveResult(None, 0, 'error: {!r}'.format(e))
+  results.put((name, result, moves, time.perf_counter() - start))
+
+def race (puzzle_class, game_id, configs=None, timeout=None, max_moves=None,
+          stats=None):
+  """
+  Solve game_id with several solver configurations at once, one process
+  each, and return (name, result) for the first to solve it. The others are
+  cancelled. If none solves it, name is None and result is the one with the
+  most edges fixed, or None if no configuration reported back.
+
+  configs maps names to Puzzle keyword arguments and defaults to
+  puzzle_class.portfolio. timeout and max_moves apply to each
+  configuration. If stats is a filename, a JSON line recording the winner
+  and every configuration's outcome is appended to it.
+  """
+  import multiprocessing
+
+  if configs is None:
+    configs = puzzle_class.portfolio
+  start = time.perf_counter()
+  cancel = multiprocessing.Event()
+  results = multiprocessing.Queue()
+  procs = [multiprocessing.Process(target=_race_worker, daemon=True,
+                                   args=(puzzle_class, game_id, name, config,
+                                         timeout, max_moves, cancel, results))
+           for name, config in configs.items()]
+  for proc in procs:
+    proc.start()
+
+  winner = won_at = None
+  outcomes = {}
+  try:
+    while len(outcomes) < len(procs):
+      try:
+        name, result, moves, elapsed = results.get(timeout=1)
+      except queue.Empty:
+        if winner or not any(proc.is_alive() for proc in procs):
+          break
+        continue
+      outcomes[name] = (result, moves, elapsed)
+      if winner is None and result.reason == 'solved':
+        winner = name
+        won_at = time.perf_counter() - start
+        cancel.set()
+  finally:
+    cancel.set()
+    for proc in procs:
+      proc.join(1)
+      if proc.is_alive():
+        proc.terminate()
+
+  if stats:
+    with open(stats, 'a') as o:
+      print(json.dumps({
+        'game': game_id,
+        'winner': winner,
+        'elapsed': won_at,
+        'outcomes': {name: {'reason': result.reason, 'fixed': result.fixed,
+                            'moves': moves, 'elapsed': elapsed}
+                     for name, (result, moves, elapsed) in outcomes.items()},
+      }), file=o)
+
+  if winner is None:
+    if not outcomes:
+      return None, None
+    best = max(outcomes, key=lambda n: outcomes[n][0].fixed)
+    return None, outcomes[best][0]
+  return winner, outcomes[winner][0]
+
 
 def main (puzzle_class):
   import argparse
@@ -275,11 +587,47 @@ def main (puzzle_class):
   ap.add_argument('-q', action='store_true', help='Suppress output')
   ap.add_argument('-n', action='store_true', help='Do not open puzzle program')
   ap.add_argument('-f', action='store_true', help='Fast drawing')
+  ap.add_argument('-t', type=float, metavar='SECONDS',
+                  help='Stop solving after this many seconds')
+  ap.add_argument('-m', type=int, metavar='MOVES',
+                  help='Stop solving after considering this many moves')
+  ap.add_argument('--profile', metavar='PREFIX',
+                  help='Profile each solve phase, writing '
+                  'PREFIX.<phase>.pstats and PREFIX.<phase>.folded files. '
+                  'Reported times include profiling and tracemalloc '
+                  'overhead')
+  ap.add_argument('-p', '--portfolio', action='store_true',
+                  help='Race the solver configurations on separate processes')
+  ap.add_argument('--stats', metavar='FILE',
+                  help='Append portfolio outcomes to FILE as JSON lines')
   args = ap.parse_args()
+  if args.portfolio and args.profile:
+    ap.error('--profile cannot be used with -p')
+  if args.stats and not args.portfolio:
+    ap.error('--stats requires -p')
 
 
   if args.game:
-    p = puzzle_class(args.game, args.q, not args.n, args.f)
+    profiler = None
+    if args.profile:
+      from profiling import Profiler
+      profiler = Profiler(args.profile)
+    p = puzzle_class(args.game, args.q, not args.n, args.f, profiler)
     print(p.game_id)
     p.print()
-    p.solve()
+    if args.portfolio:
+      winner, result = race(puzzle_class, args.game, timeout=args.t,
+                            max_moves=args.m, stats=args.stats)
+      if result is None:
+        print('No configuration finished.')
+        return
+      if winner:
+        print(winner, 'won.')
+      else:
+        print('No configuration solved it, saving the most complete grid.')
+      p.load_grid(result.grid)
+      p.save(result)
+    else:
+      p.solve(args.t, args.m)
+    if profiler:
+      profiler.report()
@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 
 from puzzle import *
+import functools
+import verify
 
 def invert (state):
   if state:
@@ -55,6 +57,39 @@ class SlantPuzzle (Puzzle):
   def _configure (self, x, y, val):
     self.vertex[y][x]._degree = val
 
+  def _post_configure (self):
+    # Index the runs of 2s along each row and column
+    for y in range(0, self.height+1):
+      self._index_runs(self.vertex[y], 1, 0)
+    for x in range(0, self.width+1):
+      self._index_runs([row[x] for row in self.vertex], 0, 1)
+
+  def _index_runs (self, line, dx, dy):
+    start = 0
+    while start < len(line):
+      if line[start]._degree != 2:
+        start += 1
+        continue
+      end = start
+      while end < len(line) and line[end]._degree == 2:
+        end += 1
+
+      run = TwoRun(line[start:end],
+                   line[start-1] if start > 0 else None,
+                   line[end] if end < len(line) else None)
+      gaps = [[run.vertices[0].edge[e] for e in which_edges(dx*-1, dy*-1)]]
+      gaps.extend([v.edge[e] for e in which_edges(dx, dy)]
+                  for v in run.vertices)
+      for gap, edges in enumerate(gaps):
+        for edge in edges:
+          if edge.solved:
+            run.update(gap, 1)
+          if edge.x is not None:
+            edge._gaps.append((run, gap))
+      for i, v in enumerate(run.vertices):
+        v._runs[dx == 0] = (run, i)
+      start = end
+
   def _undo (self, edge):
     edge.state = None
 
@@ -98,11 +133,84 @@ class SlantPuzzle (Puzzle):
   def _draw_height (self):
     return self.height*2 + 2
 
+  def _grid (self):
+    """
+    Packed grid: one character per edge, row by row, '/' or '\\' for placed
+    edges and '.' for unknown ones.
+    """
+    return ''.join('.' if not e.solved else '/' if e.state == c_slash else '\\'
+                   for row in self.edge for e in row)
+
+  def _guesses (self):
+    for node in self.unsolved_nodes:
+      if isinstance(node, EdgeNode) and not node.solved:
+        return [functools.partial(setattr, node, 'state', s)
+                for s in (c_slash, c_bslash)]
+    return []
+
+  def _load_grid (self, grid):
+    edges = (e for row in self.edge for e in row)
+    for e, c in zip(edges, grid):
+      if c != '.' and not e.solved:
+        e.state = c_slash if c == '/' else c_bslash
+
+  def _affected (self, moves):
+    return [v for e in moves for v in e.vertex if not v.solved]
+
+  def _verified (self):
+    return verify.verify(self.game_id, self._grid()) is None
+
   def _format_moves (self):
     return ['{}{},{}'.format('/' if e.state == c_slash else '\\', e.x, e.y)
             for e in self.moves]
 
 
+class TwoRun:
+  """
+  A maximal line of adjacent 2s along a row or column, in increasing x or y.
+
+  Gap g is the pair of edges between vertices[g-1] and vertices[g], with
+  gaps 0 and len(vertices) at the two ends, so vertex i has gap i behind it
+  and gap i+1 ahead of it. solved counts the solved edges in each gap and
+  mask has bit g set while gap g has any, kept current by EdgeNode.
+
+  Walks through the run cost O(number of gaps with a solved edge), not
+  O(1): empty stretches are skipped in one step, but on a mostly filled
+  board that is close to the run length again, just with a cheaper step.
+  """
+  def __init__ (self, vertices, before, after):
+    self.vertices = vertices
+    self.before = before
+    self.after = after
+    self.solved = [0] * (len(vertices) + 1)
+    self.mask = 0
+
+  def update (self, gap, delta):
+    self.solved[gap] += delta
+    if self.solved[gap]:
+      self.mask |= 1 << gap
+    else:
+      self.mask &= ~(1 << gap)
+
+  def solved_gaps (self, i, forward):
+    """
+    Indices of the vertices from i on, walking forward or backward, whose
+    gap on the far side has a solved edge.
+    """
+    if forward:
+      m = self.mask >> (i + 1)
+      while m:
+        low = m & -m
+        yield i + low.bit_length() - 1
+        m ^= low
+    else:
+      m = self.mask & ((2 << i) - 1)
+      while m:
+        j = m.bit_length() - 1
+        yield j
+        m ^= 1 << j
+
+
 class EdgeNode (Node):
   """
   Vertex order is: (1,1) (0,1) (1,0) (0,0)
@@ -117,6 +225,9 @@ class EdgeNode (Node):
   def __init__ (self, puzzle, x, y, state=None):
     super().__init__(puzzle, x, y)
     self._state = state
+    self._gaps = []
+    # The component root this edge's line attached, for undo
+    self._joined = None
 
   def __str__ (self):
     return str(self.state) if self.state else '\u3000'
@@ -131,7 +242,7 @@ class EdgeNode (Node):
 
   @state.setter
   def state (self, value):
-    self._state = value
+    self._set_state(value)
     if value:
       self.puzzle.move(self)
 
@@ -140,45 +251,94 @@ class EdgeNode (Node):
         v.solved
 
       self._cycle_check()
+      self.puzzle._check_budget()
+
+  def _set_state (self, value):
+    if (self._state is None) != (value is None):
+      delta = 1 if value is not None else -1
+      for run, gap in self._gaps:
+        run.update(gap, delta)
+      if value is not None:
+        self._joined = VertexNode.join(*self.ends(value))
+      elif self._joined is not None:
+        # Moves are undone last-first, so this was the latest join
+        VertexNode.split(self._joined)
+        self._joined = None
+    self._state = value
+
+  def ends (self, state):
+    """
+    The two vertices a line in the given state connects.
+    """
+    if state == c_slash:
+      return self.vertex[1], self.vertex[2]
+    return self.vertex[0], self.vertex[3]
+
+  def _fits (self, state):
+    """
+    Whether state can be placed without overfilling a clue or closing a loop.
+    """
+    for n, v in enumerate(self.vertex):
+      if v._degree is not None:
+        if connect_edge(n) == state:
+          if v.degree >= v._degree:
+            return False
+        elif v.antidegree >= v._antidegree:
+          return False
+    vert_a, vert_b = self.ends(state)
+    return vert_a.component is not vert_b.component
 
   @property
   def solved (self):
     return self.state is not None
 
   def _cycle_check (self):
-    if self._state == c_slash:
-      vert_a = self.vertex[1]
-      vert_b = self.vertex[2]
-    else:
-      vert_a = self.vertex[0]
-      vert_b = self.vertex[3]
-
-    if vert_a.degree > 1 and vert_b.degree > 1:
-      cycle = vert_a.find_cycle()
-      if cycle:
-        self.puzzle.print(errors=cycle, wait=waittime*1.5)
-      assert not cycle
+    # The line closed a loop if its ends were already in one component
+    if self._joined is None:
+      if not self.puzzle._quiet:
+        cycle = self.vertex[0 if self._state == c_bslash else 1].find_cycle()
+        self.puzzle.print(errors=cycle or [], wait=waittime*1.5)
+    assert self._joined is not None
+    return False
+
+  def _recheck (self):
+    # Queued by a join: a state whose ends share a component forces the
+    # other one.
+    if not self.solved:
+      for s in (c_slash, c_bslash):
+        vert_a, vert_b = self.ends(s)
+        if vert_a.component is vert_b.component:
+          self.state = invert(s)
+          return [v for v in self.vertex if not v.solved]
     return False
 
   _last_moves = None
   def _solve (self):
     if not self.solved:
-      expanded_strategy = self._last_moves == self.puzzle.moves
+      # Direct deductions first: a state that overfills a clue or closes a
+      # loop forces the other one, without a trial placement.
+      for s in (c_slash, c_bslash):
+        if not self._fits(s):
+          self.state = invert(s)
+          return (v for v in self.vertex if not v.solved)
+
+      expanded_strategy = (self.puzzle.expanded and
+                           self._last_moves == self.puzzle.moves)
       self._last_moves = list(self.puzzle.moves)
+      if not expanded_strategy:
+        return False
       try:
         for s in (c_slash, c_bslash):
-          mark = self.puzzle.undo_mark();
+          mark = self.puzzle.trial_mark()
           self.state = s
-          if expanded_strategy:
-            for v in self.vertex:
-              if not v.solved:
-                v.solve()
+          for v in self.vertex:
+            if not v.solved:
+              v.solve()
           self.puzzle.undo(mark)
       except AssertionError:
         s = invert(self.state)
         self.puzzle.undo(mark)
-        self._state = s
-        self.puzzle.move(self)
+        self.state = s
         return (v for v in self.vertex if not v.solved)
     return False
 
@@ -220,6 +380,16 @@ class VertexNode (DegreeNode):
   # to left-to-right, top-to-bottom edge ordering.
   offset = (1, 2**2, 2**6, 2**4)
   offset_nums = (1, 2, 8, 4)
+
+  def __init__ (self, puzzle, x, y, degree=None):
+    super().__init__(puzzle, x, y, degree)
+    # (TwoRun, index) along the row and along the column, for 2s only
+    self._runs = [None, None]
+    # Union-find over the vertices joined by placed lines. No path
+    # compression, so joins can be undone in reverse order.
+    self._parent = self
+    self._members = [self]
+
   def __str__ (self):
     if self._degree is not None:
       offset = 0
@@ -280,18 +450,23 @@ class VertexNode (DegreeNode):
           edge.state = slash(e)
           changed.append(edge)
     elif self._degree == 2:
-      if sum(self.edge[e].solved for e in (e1, e2)) == 1:
-        if self.edge[e1].solved:
-          self.edge[e2].state = self.edge[e1].state
-          changed.append(self.edge[e2])
-        else:
-          self.edge[e1].state = self.edge[e2].state
-          changed.append(self.edge[e1])
-
-      try:
-        changed.extend(self.adjacent_vertex(dx, dy)._parallel(dx, dy))
-      except IndexError:
-        pass
+      # Parallel lines carry through the whole run of 2s. Only the 2s with a
+      # solved edge on the far side can have one to copy.
+      run, i = self._runs[dx == 0]
+      forward = dx + dy > 0
+      for j in run.solved_gaps(i, forward):
+        v = run.vertices[j]
+        if sum(v.edge[e].solved for e in (e1, e2)) == 1:
+          if v.edge[e1].solved:
+            v.edge[e2].state = v.edge[e1].state
+            changed.append(v.edge[e2])
+          else:
+            v.edge[e1].state = v.edge[e2].state
+            changed.append(v.edge[e1])
+
+      end = run.after if forward else run.before
+      if end is not None:
+        changed.extend(end._parallel(dx, dy))
 
     return changed
 
@@ -345,7 +520,6 @@ class VertexNode (DegreeNode):
                 def parallel_both ():
                   changes.extend(ov._parallel(dx, dy))
                   parallel_self()
-                twos = []
                 def interesting_node (v):
                   if v._is_parallel(dx, dy):
                     return parallel_self
@@ -369,13 +543,29 @@ class VertexNode (DegreeNode):
                       return parallel_both
                   return None
 
-                while ov._degree == 2 and not interesting_node(ov):
-                  twos.append(ov)
-                  ov = ov.adjacent_vertex(dx, dy)
+                twos = None
+                if ov._degree == 2:
+                  # A 2 can only be interesting with a solved edge on its far
+                  # side, so jump between those and then past the run.
+                  run, i = ov._runs[dx == 0]
+                  forward = dx + dy > 0
+                  for j in run.solved_gaps(i, forward):
+                    if interesting_node(run.vertices[j]):
+                      ov = run.vertices[j]
+                      break
+                  else:
+                    j = len(run.vertices) if forward else -1
+                    ov = run.after if forward else run.before
+                  lo, hi = (i, j) if forward else (j+1, i+1)
+                  twos = run.vertices, lo, hi
+                  if ov is None:
+                    raise IndexError()
 
                 act = interesting_node(ov)
                 if act:
-                  self.puzzle.checking.update(twos)
+                  if twos:
+                    vertices, lo, hi = twos
+                    self.puzzle.checking.update(vertices[lo:hi])
                   self.puzzle.checking.add(ov)
                   act()
 
@@ -388,7 +578,8 @@ class VertexNode (DegreeNode):
                 changes.extend(
                   self.puzzle.vertex[self.y+dy][self.x+dx]._parallel(dx, dy))
 
-        if (self._solve_chain_initiator and not changes and
+        if (self._solve_chain_initiator and self.puzzle.expanded and
+            not changes and
             0 < self.x < self.puzzle.width and 0 < self.y < self.puzzle.height):
           # Consider only the diagonals
           for dy in (-1, 1):
@@ -413,7 +604,7 @@ class VertexNode (DegreeNode):
 
               self.puzzle.checking.add(ov)
               try:
-                mark = self.puzzle.undo_mark();
+                mark = self.puzzle.trial_mark()
                 edge.state = connect_edge(e)
 
                 try_changes = self._satisfy()
@@ -424,8 +615,7 @@ class VertexNode (DegreeNode):
               except AssertionError:
                 s = invert(edge.state)
                 self.puzzle.undo(mark)
-                edge._state = s
-                self.puzzle.move(edge)
+                edge.state = s
                 changes.append(edge)
 
 
@@ -435,6 +625,46 @@ class VertexNode (DegreeNode):
         return (v for e in changes for v in e.vertex if not v.solved)
     return False
 
+  @property
+  def component (self):
+    v = self
+    while v._parent is not v:
+      v = v._parent
+    return v
+
+  @staticmethod
+  def join (vert_a, vert_b):
+    """
+    Merge the components of two vertices. Returns the root that was
+    attached, to pass to split(), or None if they were already joined.
+
+    Unsolved edges whose diagonal now runs between two vertices of the
+    merged component can no longer take that orientation, so they are
+    queued on puzzle.pending for EdgeNode._recheck.
+    """
+    root_a = vert_a.component
+    root_b = vert_b.component
+    if root_a is root_b:
+      return None
+    if len(root_a._members) < len(root_b._members):
+      root_a, root_b = root_b, root_a
+
+    pending = vert_a.puzzle.pending
+    for v in root_b._members:
+      for n, e in enumerate(v.edge):
+        if (e.x is not None and not e.solved and
+            e.vertex[3-n].component is root_a):
+          pending.append(e)
+
+    root_b._parent = root_a
+    root_a._members.extend(root_b._members)
+    return root_b
+
+  @staticmethod
+  def split (root):
+    del root._parent._members[-len(root._members):]
+    root._parent = root
+
   def find_cycle (self, vertex=None, visited=None):
     if self is vertex:
       return []
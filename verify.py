@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+"""
+Independent Slant solution checker. Shares only the game ID parsing helpers
+with the solver, so it can be used to cross-check any solving engine.
+"""
+
+from puzzle import expand, game_id_re
+import re, sys
+
+move_re = re.compile(r'([/\\])(\d+),(\d+)')
+
+def parse_clues (game_id):
+  """
+  Returns (width, height, clues) where clues is a flat row-major list of
+  (width+1)*(height+1) vertex clues, -1 where there is none.
+  """
+  m = re.match(game_id_re, game_id)
+  if not m:
+    raise ValueError('Bad game ID: {}'.format(game_id))
+  width = int(m.group('width'))
+  height = int(m.group('height'))
+  size = (width+1) * (height+1)
+
+  clues = []
+  for c in m.group('game'):
+    if c.isalpha():
+      clues.extend([-1] * expand(c))
+    else:
+      clues.append(int(c))
+  if len(clues) != size:
+    raise ValueError('Game description has {} vertices, expected {}'.format(
+      len(clues), size))
+  return width, height, clues
+
+def parse_solution (solution, width, height):
+  """
+  Accepts a packed grid (width*height characters of '/', '\\' and '.' for
+  unfilled squares, row by row, as in SolveResult.grid), or moves like
+  '/3,4' either as a list or a ';' separated string. Later moves override
+  earlier ones.
+  """
+  if isinstance(solution, str):
+    if len(solution) == width * height and not solution.strip('/\\.'):
+      return solution
+    solution = solution.replace(';', ' ').split()
+
+  grid = ['.'] * (width * height)
+  for move in solution:
+    m = move_re.fullmatch(move)
+    if not m:
+      raise ValueError('Bad move: {}'.format(move))
+    x, y = int(m.group(2)), int(m.group(3))
+    if not (0 <= x < width and 0 <= y < height):
+      raise ValueError('Bad move: {}'.format(move))
+    grid[y*width + x] = move[0]
+  return ''.join(grid)
+
+def verify (game_id, solution):
+  """
+  Check a solution in one pass over the grid: per-vertex degree counting
+  for the clues and a union-find over vertices for loops.
+
+  Returns None if the solution is valid, otherwise a message describing the
+  first problem found.
+  """
+  width, height, clues = parse_clues(game_id)
+  grid = parse_solution(solution, width, height)
+
+  stride = width + 1
+  degree = [0] * len(clues)
+  parent = list(range(len(clues)))
+
+  def find (v):
+    while parent[v] != v:
+      parent[v] = v = parent[parent[v]]
+    return v
+
+  for y in range(height):
+    row = y * stride
+    for x in range(width):
+      s = grid[y*width + x]
+      if s == '\\':
+        a = row + x
+        b = a + stride + 1
+      elif s == '/':
+        a = row + x + 1
+        b = a + stride - 1
+      else:
+        return 'Unfilled square at {},{}'.format(x, y)
+      degree[a] += 1
+      degree[b] += 1
+      ra = find(a)
+      rb = find(b)
+      if ra == rb:
+        return 'Loop closed at {},{}'.format(x, y)
+      parent[ra] = rb
+
+  for v, clue in enumerate(clues):
+    if clue >= 0 and degree[v] != clue:
+      return 'Vertex {},{} has {} lines, clue is {}'.format(
+        v % stride, v // stride, degree[v], clue)
+  return None
+
+
+def main ():
+  import argparse
+
+  ap = argparse.ArgumentParser(description='Verify Slant solutions')
+  ap.add_argument('file', nargs='?', type=argparse.FileType('r'),
+                  default=sys.stdin,
+                  help='Lines of "<game ID> <solution>", where the solution is '
+                  'a packed grid or ";" separated moves. Defaults to stdin')
+  ap.add_argument('-q', action='store_true', help='Only print the summary')
+  args = ap.parse_args()
+
+  good = bad = 0
+  for lineno, line in enumerate(args.file, 1):
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    game_id, _, solution = line.partition(' ')
+    try:
+      error = verify(game_id, solution)
+    except ValueError as e:
+      error = str(e)
+    if error:
+      bad += 1
+      if not args.q:
+        print('{}: {}: {}'.format(lineno, game_id, error))
+    else:
+      good += 1
+
+  print('{} valid, {} invalid.'.format(good, bad))
+  return 1 if bad else 0
+
+if __name__ == '__main__':
+  sys.exit(main())